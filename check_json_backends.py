@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Check that every installed JSON backend hashes rows the same way.
+
+record_hash/workout_hash must not depend on whether orjson, ujson or only the
+stdlib is installed, or re-imports would duplicate rows.
+
+Usage:
+  python check_json_backends.py
+"""
+
+from hashlib import sha256
+
+import export_rows
+from export_rows import canonical_json, hash_json
+
+SAMPLES = [
+    {"type": "HKQuantityTypeIdentifierStepCount", "value": "12", "unit": "count"},
+    {"sourceName": "Ana’s Apple Watch", "device": "<<HKDevice: 0x1>, name:Watch>"},
+    {"text": "café 😀   \u0000\t\n\x1f \x7f \\ \" / </script>"},
+    ({"b": "1", "a": "2"}, {"HKMetadataKeySyncVersion": 2, "ratio": 1.5}),
+    {"empty": {}, "list": [], "nested": [{"z": None, "y": True}]},
+]
+
+
+def main():
+    backends = {"stdlib": canonical_json}
+    if export_rows.orjson is not None:
+        backends["orjson"] = export_rows._orjson_dumps
+    if export_rows.ujson is not None:
+        backends["ujson"] = export_rows._ujson_dumps
+
+    for value in SAMPLES:
+        expected = sha256(canonical_json(value)).hexdigest()
+        for name, dumps in backends.items():
+            got = hash_json(value, dumps(value))
+            assert got == expected, f"{name} hash differs for {value!r}"
+
+    print(f"ok: {', '.join(backends)} agree on {len(SAMPLES)} samples")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+# cython: language_level=3, boundscheck=False, cdivision=True
+"""Row builders for parse_export.py.
+
+Plain Python so the script works anywhere; `python setup.py build_ext --inplace`
+compiles it with Cython and the extension is picked up in place of this file.
+"""
+import json
+import sys
+from hashlib import sha256
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup, ujson/stdlib fallback below
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover - optional speedup, stdlib fallback below
+    ujson = None
+
+DURATION_MULTIPLIERS = {
+    "s": 1,
+    "sec": 1,
+    "min": 60,
+    "hr": 3600,
+    "hour": 3600,
+}
+
+# Source, type and unit strings repeat across millions of rows; sharing one
+# object per value shrinks the results pickled back from --workers processes.
+# Device strings embed per-object pointers, so they are left out.
+INTERN_CACHE_SIZE = 10000
+_intern_cache = {}
+
+
+class ExportNode:
+    """Minimal stand-in for an XML element: a tag, its attributes and child nodes."""
+
+    __slots__ = ("tag", "attrib", "children")
+
+    def __init__(self, tag, attrib, children=None):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = [] if children is None else children
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+
+def export_payload(elem):
+    """Flatten an element subtree into nested (tag, attrib, children) tuples.
+
+    Plain tuples pickle several times faster than ExportNode instances, which
+    matters when the parse process hands every record to pool workers.
+    """
+    return (
+        elem.tag,
+        attrib_dict(elem),
+        [export_payload(child) if len(child) else (child.tag, attrib_dict(child), ())
+         for child in elem],
+    )
+
+
+def node_from_payload(payload):
+    tag, attrib, children = payload
+    return ExportNode(
+        tag,
+        attrib,
+        [node_from_payload(child) if child[2] else ExportNode(child[0], child[1])
+         for child in children],
+    )
+
+
+def attrib_dict(elem):
+    """Return elem's attributes as a dict, copying only when they are not one already.
+
+    expat and ExportNode attributes are plain dicts (with interned keys) that
+    nothing mutates, so they are used as-is. lxml's attribute view still has to
+    be materialized because orjson only serializes real dicts.
+    """
+    attrib = elem.attrib
+    if type(attrib) is dict:
+        return attrib
+    intern = sys.intern
+    return {intern(key): value for key, value in attrib.items()}
+
+
+def shared_value(value):
+    """Return a shared instance of a low-cardinality attribute value."""
+    cached = _intern_cache.get(value)
+    if cached is None:
+        if value is None:
+            return None
+        if len(_intern_cache) >= INTERN_CACHE_SIZE:
+            _intern_cache.clear()
+        cached = _intern_cache[value] = value
+    return cached
+
+
+def to_float(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def add_metadata(metadata, key, value):
+    if key is None:
+        return
+    if key in metadata:
+        existing = metadata[key]
+        if isinstance(existing, list):
+            existing.append(value)
+        else:
+            metadata[key] = [existing, value]
+    else:
+        metadata[key] = value
+
+
+def serialize_elem(root):
+    """Serialize a subtree iteratively; HRV lists can hold hundreds of children."""
+    result = {"tag": root.tag, "attributes": attrib_dict(root)}
+    pending = [(root, result)] if len(root) else []
+    while pending:
+        elem, data = pending.pop()
+        children = data["children"] = []
+        for child in elem:
+            child_data = {"tag": child.tag, "attributes": attrib_dict(child)}
+            children.append(child_data)
+            if len(child):
+                pending.append((child, child_data))
+    return result
+
+
+_encode_canonical_json = json.JSONEncoder(separators=(",", ":"), sort_keys=True).encode
+
+
+def canonical_json(value):
+    """The stdlib, \\u-escaped JSON bytes every record/workout hash is computed over."""
+    return _encode_canonical_json(value).encode()
+
+
+def hash_json(value, value_json):
+    """sha256 of canonical_json(value), reusing dumps_json() output when identical.
+
+    orjson writes non-ASCII characters and DEL unescaped; only those payloads
+    need the canonical re-encode, so hashes match rows loaded by earlier runs.
+    """
+    if value_json.isascii() and b"\x7f" not in value_json:
+        return sha256(value_json).hexdigest()
+    return sha256(canonical_json(value)).hexdigest()
+
+
+# hash_json() always hashes the stdlib, \u-escaped canonical_json() bytes, which
+# is what earlier loads stored. ujson only differs from it for DEL and orjson
+# for non-ASCII and DEL; hash_json() re-encodes exactly those payloads.
+# check_json_backends.py asserts the backends agree.
+def _orjson_dumps(value):
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+
+def _ujson_dumps(value):
+    return ujson.dumps(value, sort_keys=True, escape_forward_slashes=False).encode()
+
+
+if orjson is not None:
+    dumps_json = _orjson_dumps
+elif ujson is not None:
+    dumps_json = _ujson_dumps
+else:
+    dumps_json = canonical_json
+
+
+def skip_raw_hash_input(attrib, metadata_bytes):
+    """dumps_json((attrib, metadata)), reusing the already serialized metadata."""
+    return b"[" + dumps_json(attrib) + b"," + (metadata_bytes or b"{}") + b"]"
+
+
+def build_record_row(elem, keep_raw=True):
+    attrib = attrib_dict(elem)
+    metadata = {}
+    extra_children = []
+
+    for child in elem:
+        if child.tag == "MetadataEntry":
+            add_metadata(metadata, child.attrib.get("key"), child.attrib.get("value"))
+        elif keep_raw:
+            extra_children.append(serialize_elem(child))
+
+    value_raw = attrib.get("value")
+    # Inlined to_float(): this runs for every record.
+    try:
+        value_numeric = float(value_raw)
+    except (TypeError, ValueError):
+        value_numeric = None
+    value_text = None
+    if value_raw is not None and value_numeric is None:
+        value_text = value_raw
+
+    metadata_bytes = dumps_json(metadata) if metadata else None
+    metadata_json = metadata_bytes.decode() if metadata_bytes else None
+    if keep_raw:
+        raw = {"attributes": attrib}
+        if metadata:
+            raw["metadata"] = metadata
+        if extra_children:
+            raw["children"] = extra_children
+        raw_json = dumps_json(raw)
+        record_hash = hash_json(raw, raw_json)
+        raw_json = raw_json.decode()
+    else:
+        record_hash = hash_json((attrib, metadata), skip_raw_hash_input(attrib, metadata_bytes))
+        raw_json = None
+
+    return (
+        shared_value(attrib.get("type")),
+        shared_value(attrib.get("sourceName")),
+        shared_value(attrib.get("sourceVersion")),
+        shared_value(attrib.get("sourceBundleIdentifier")),
+        attrib.get("device"),
+        shared_value(attrib.get("unit")),
+        value_numeric,
+        value_text,
+        attrib.get("startDate"),
+        attrib.get("endDate"),
+        attrib.get("creationDate"),
+        metadata_json,
+        record_hash,
+        raw_json,
+    )
+
+
+def build_workout_row(elem, keep_raw=True):
+    attrib = attrib_dict(elem)
+    metadata = {}
+    stats = []
+    routes = []
+    extra_children = []
+
+    avg_hr = None
+    min_hr = None
+    max_hr = None
+    total_energy = None
+    total_energy_unit = None
+    total_distance = None
+    total_distance_unit = None
+    route_file = None
+
+    for child in elem:
+        if child.tag == "MetadataEntry":
+            add_metadata(metadata, child.attrib.get("key"), child.attrib.get("value"))
+            continue
+
+        if child.tag == "WorkoutStatistics":
+            # With --skip-raw only the typed columns below need the statistics.
+            if keep_raw:
+                stat = attrib_dict(child)
+                stats.append(stat)
+            else:
+                stat = child.attrib
+            stat_type = stat.get("type")
+            if stat_type == "HKQuantityTypeIdentifierHeartRate":
+                avg_hr = to_float(stat.get("average"))
+                min_hr = to_float(stat.get("minimum"))
+                max_hr = to_float(stat.get("maximum"))
+            elif stat_type == "HKQuantityTypeIdentifierActiveEnergyBurned":
+                total_energy = to_float(stat.get("sum"))
+                total_energy_unit = stat.get("unit")
+            elif stat_type and stat_type.startswith("HKQuantityTypeIdentifierDistance"):
+                if total_distance is None:
+                    total_distance = to_float(stat.get("sum"))
+                    total_distance_unit = stat.get("unit")
+            continue
+
+        if child.tag == "WorkoutRoute":
+            if keep_raw:
+                route_data = {"attributes": attrib_dict(child)}
+                routes.append(route_data)
+            for route_child in child:
+                if route_child.tag == "FileReference":
+                    route_path = route_child.attrib.get("path")
+                    if route_path:
+                        if keep_raw:
+                            route_data.setdefault("files", []).append(route_path)
+                        if route_file is None:
+                            route_file = route_path
+                elif keep_raw:
+                    route_data.setdefault("children", []).append(serialize_elem(route_child))
+            continue
+
+        if keep_raw:
+            extra_children.append(serialize_elem(child))
+
+    duration_seconds = None
+    duration_raw = attrib.get("duration")
+    duration_unit = attrib.get("durationUnit")
+    duration_value = to_float(duration_raw)
+    if duration_value is not None:
+        duration_seconds = duration_value * DURATION_MULTIPLIERS.get(duration_unit, 1)
+
+    metadata_bytes = dumps_json(metadata) if metadata else None
+    metadata_json = metadata_bytes.decode() if metadata_bytes else None
+    if keep_raw:
+        raw = {"attributes": attrib}
+        if metadata:
+            raw["metadata"] = metadata
+        if stats:
+            raw["statistics"] = stats
+        if routes:
+            raw["routes"] = routes
+        if extra_children:
+            raw["children"] = extra_children
+        raw_json = dumps_json(raw)
+        workout_hash = hash_json(raw, raw_json)
+        raw_json = raw_json.decode()
+    else:
+        workout_hash = hash_json((attrib, metadata), skip_raw_hash_input(attrib, metadata_bytes))
+        raw_json = None
+
+    return (
+        shared_value(attrib.get("workoutActivityType")),
+        shared_value(attrib.get("sourceName")),
+        shared_value(attrib.get("sourceVersion")),
+        shared_value(attrib.get("sourceBundleIdentifier")),
+        attrib.get("device"),
+        attrib.get("startDate"),
+        attrib.get("endDate"),
+        duration_seconds,
+        duration_unit,
+        total_energy,
+        total_energy_unit,
+        total_distance,
+        total_distance_unit,
+        avg_hr,
+        min_hr,
+        max_hr,
+        route_file,
+        metadata_json,
+        workout_hash,
+        raw_json,
+    )
+
+
+def build_export_rows(payloads, keep_raw=True):
+    """Build (tag, row) pairs for a chunk of export_payload() tuples in a worker."""
+    rows = []
+    for payload in payloads:
+        node = node_from_payload(payload)
+        if node.tag == "Record":
+            rows.append(("Record", build_record_row(node, keep_raw)))
+        else:
+            rows.append(("Workout", build_workout_row(node, keep_raw)))
+    return rows
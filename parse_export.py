@@ -1,20 +1,35 @@
 #!/usr/bin/env python3
 import argparse
-import hashlib
-import json
 import os
+import queue
 import sys
+import threading
 import time
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+from export_rows import (
+    ExportNode,
+    build_export_rows,
+    build_record_row,
+    build_workout_row,
+    export_payload,
+)
+
+try:
+    from lxml import etree
+except ImportError:  # pragma: no cover - optional speedup, expat fallback below
+    etree = None
 
 try:
-    import psycopg2
-    from psycopg2.extras import execute_values
+    import psycopg
+    from psycopg.copy import QueuedLibpqWriter
 except ImportError:  # pragma: no cover - runtime dependency check
-    psycopg2 = None
-    execute_values = None
+    psycopg = None
+    QueuedLibpqWriter = None
 
 RECORD_COLUMNS = (
     "record_type",
@@ -56,213 +71,216 @@ WORKOUT_COLUMNS = (
     "raw",
 )
 
-RECORD_INSERT_SQL = (
-    f"INSERT INTO health_raw ({', '.join(RECORD_COLUMNS)}) VALUES %s "
-    "ON CONFLICT (record_hash) DO NOTHING"
-)
-WORKOUT_INSERT_SQL = (
-    f"INSERT INTO workouts ({', '.join(WORKOUT_COLUMNS)}) VALUES %s "
-    "ON CONFLICT (workout_hash) DO NOTHING"
-)
-
-DURATION_MULTIPLIERS = {
-    "s": 1,
-    "sec": 1,
-    "min": 60,
-    "hr": 3600,
-    "hour": 3600,
+# Unique column each target table dedupes on
+CONFLICT_COLUMNS = {
+    "health_raw": "record_hash",
+    "workouts": "workout_hash",
 }
 
+EXPORT_TAGS = ("Record", "Workout")
+
+EXPAT_READ_SIZE = 1 << 20
+
+# Elements per chunk handed to --workers
+CHUNK_SIZE = 1000
+# Parsed chunks the --workers 1 parse thread may run ahead by
+THREAD_QUEUE_SIZE = 4
+
 
 def find_default_export():
     candidates = sorted(Path(".").glob("export-*/apple_health_export/export.xml"))
     return candidates[-1] if candidates else None
 
 
-def to_float(value):
-    if value is None:
-        return None
-    try:
-        return float(value)
-    except (TypeError, ValueError):
-        return None
-
-
-def add_metadata(metadata, key, value):
-    if key is None:
+class ExpatHandler:
+    """Collect Record/Workout subtrees as ExportNodes, ignoring everything else."""
+
+    def __init__(self):
+        self.stack = []
+        self.completed = []
+
+    def start(self, tag, attrib):
+        stack = self.stack
+        if stack:
+            node = ExportNode(tag, attrib)
+            stack[-1].children.append(node)
+            stack.append(node)
+        elif tag in EXPORT_TAGS:
+            stack.append(ExportNode(tag, attrib))
+
+    def end(self, tag):
+        stack = self.stack
+        if stack:
+            node = stack.pop()
+            if not stack:
+                self.completed.append(node)
+
+
+def iter_expat_elements(export_path):
+    """Stream Record/Workout nodes straight from expat without building a tree."""
+    handler = ExpatHandler()
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    completed = handler.completed
+
+    with open(export_path, "rb") as f:
+        while True:
+            chunk = f.read(EXPAT_READ_SIZE)
+            parser.Parse(chunk, not chunk)
+            yield from completed
+            completed.clear()
+            if not chunk:
+                break
+
+
+def iter_export_elements(export_path):
+    """Yield each Record and Workout element, freeing it once the caller is done."""
+    if etree is None:
+        yield from iter_expat_elements(export_path)
         return
-    if key in metadata:
-        existing = metadata[key]
-        if isinstance(existing, list):
-            existing.append(value)
-        else:
-            metadata[key] = [existing, value]
-    else:
-        metadata[key] = value
 
+    # libxml2 filters tags in C, so only Record/Workout ever reach Python.
+    for _, elem in etree.iterparse(
+        str(export_path), events=("end",), tag=EXPORT_TAGS, huge_tree=False
+    ):
+        yield elem
+        elem.clear()
+        # lxml keeps already-seen siblings alive through the parent.
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def iter_payload_chunks(export_path):
+    """Yield lists of export_payload() tuples, CHUNK_SIZE elements at a time."""
+    chunk = []
+    for elem in iter_export_elements(export_path):
+        chunk.append(export_payload(elem))
+        if len(chunk) >= CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def put_until_stopped(chunks, item, stop):
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def parse_into_queue(export_path, chunks, stop):
+    """Parse-thread body: queue payload chunks, then None or the exception raised."""
+    try:
+        for chunk in iter_payload_chunks(export_path):
+            if not put_until_stopped(chunks, chunk, stop):
+                return
+        end = None
+    except BaseException as exc:  # re-raised on the consuming thread
+        end = exc
+    put_until_stopped(chunks, end, stop)
+
+
+def iter_thread_rows(export_path, keep_raw):
+    """Build rows on this thread while a background thread keeps parsing."""
+    chunks = queue.Queue(maxsize=THREAD_QUEUE_SIZE)
+    stop = threading.Event()
+    parser = threading.Thread(
+        target=parse_into_queue, args=(export_path, chunks, stop), daemon=True
+    )
+    parser.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield from build_export_rows(chunk, keep_raw)
+    finally:
+        stop.set()
+        parser.join()
+
+
+def iter_pool_rows(export_path, keep_raw, workers):
+    """Build rows in worker processes, keeping a bounded number of chunks in flight."""
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in iter_payload_chunks(export_path):
+            pending.append(pool.submit(build_export_rows, chunk, keep_raw))
+            if len(pending) > workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def iter_export_rows(export_path, keep_raw=True, workers=0):
+    """Yield ("Record" | "Workout", row) pairs in document order."""
+    if workers > 1:
+        yield from iter_pool_rows(export_path, keep_raw, workers)
+        return
+    if workers == 1:
+        yield from iter_thread_rows(export_path, keep_raw)
+        return
 
-def serialize_elem(elem):
-    data = {"tag": elem.tag, "attributes": dict(elem.attrib)}
-    if len(elem):
-        data["children"] = [serialize_elem(child) for child in elem]
-    return data
+    for elem in iter_export_elements(export_path):
+        if elem.tag == "Record":
+            yield "Record", build_record_row(elem, keep_raw)
+        else:
+            yield "Workout", build_workout_row(elem, keep_raw)
 
 
-def hash_json(raw_json):
-    return hashlib.sha256(raw_json.encode("utf-8")).hexdigest()
+def create_stage_tables(conn):
+    """Create session-local, WAL-free copies of the target tables for COPY."""
+    with conn.cursor() as cur:
+        for table, columns in (("health_raw", RECORD_COLUMNS), ("workouts", WORKOUT_COLUMNS)):
+            cur.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {table}_stage AS "
+                f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA"
+            )
+    conn.commit()
 
 
-def build_record_row(elem):
-    attrib = dict(elem.attrib)
-    metadata = {}
-    extra_children = []
+def merge_stage(conn, table, columns):
+    """Move staged rows into the target table, keeping ON CONFLICT dedup."""
+    column_list = ", ".join(columns)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {table}_stage "
+            f"ON CONFLICT ({CONFLICT_COLUMNS[table]}) DO NOTHING"
+        )
+        cur.execute(f"TRUNCATE {table}_stage")
 
-    for child in elem:
-        if child.tag == "MetadataEntry":
-            add_metadata(metadata, child.attrib.get("key"), child.attrib.get("value"))
-        else:
-            extra_children.append(serialize_elem(child))
-
-    value_raw = attrib.get("value")
-    value_numeric = to_float(value_raw)
-    value_text = None
-    if value_raw is not None and value_numeric is None:
-        value_text = value_raw
-
-    raw = {"attributes": attrib}
-    if metadata:
-        raw["metadata"] = metadata
-    if extra_children:
-        raw["children"] = extra_children
-
-    metadata_json = json.dumps(metadata, separators=(",", ":"), sort_keys=True) if metadata else None
-    raw_json = json.dumps(raw, separators=(",", ":"), sort_keys=True)
-    record_hash = hash_json(raw_json)
-
-    return (
-        attrib.get("type"),
-        attrib.get("sourceName"),
-        attrib.get("sourceVersion"),
-        attrib.get("sourceBundleIdentifier"),
-        attrib.get("device"),
-        attrib.get("unit"),
-        value_numeric,
-        value_text,
-        attrib.get("startDate"),
-        attrib.get("endDate"),
-        attrib.get("creationDate"),
-        metadata_json,
-        record_hash,
-        raw_json,
-    )
 
+@contextmanager
+def stream_stage_copy(conn, table, columns):
+    """Open a COPY into the stage table and yield its write_row.
 
-def build_workout_row(elem):
-    attrib = dict(elem.attrib)
-    metadata = {}
-    stats = []
-    routes = []
-    extra_children = []
-
-    avg_hr = None
-    min_hr = None
-    max_hr = None
-    total_energy = None
-    total_energy_unit = None
-    total_distance = None
-    total_distance_unit = None
-    route_file = None
-
-    for child in elem:
-        if child.tag == "MetadataEntry":
-            add_metadata(metadata, child.attrib.get("key"), child.attrib.get("value"))
-            continue
-
-        if child.tag == "WorkoutStatistics":
-            stat = dict(child.attrib)
-            stats.append(stat)
-            stat_type = stat.get("type")
-            if stat_type == "HKQuantityTypeIdentifierHeartRate":
-                avg_hr = to_float(stat.get("average"))
-                min_hr = to_float(stat.get("minimum"))
-                max_hr = to_float(stat.get("maximum"))
-            elif stat_type == "HKQuantityTypeIdentifierActiveEnergyBurned":
-                total_energy = to_float(stat.get("sum"))
-                total_energy_unit = stat.get("unit")
-            elif stat_type and stat_type.startswith("HKQuantityTypeIdentifierDistance"):
-                if total_distance is None:
-                    total_distance = to_float(stat.get("sum"))
-                    total_distance_unit = stat.get("unit")
-            continue
-
-        if child.tag == "WorkoutRoute":
-            route_data = {"attributes": dict(child.attrib)}
-            for route_child in child:
-                if route_child.tag == "FileReference":
-                    route_path = route_child.attrib.get("path")
-                    if route_path:
-                        route_data.setdefault("files", []).append(route_path)
-                        if route_file is None:
-                            route_file = route_path
-                else:
-                    route_data.setdefault("children", []).append(serialize_elem(route_child))
-            routes.append(route_data)
-            continue
-
-        extra_children.append(serialize_elem(child))
-
-    duration_seconds = None
-    duration_raw = attrib.get("duration")
-    duration_unit = attrib.get("durationUnit")
-    duration_value = to_float(duration_raw)
-    if duration_value is not None:
-        multiplier = DURATION_MULTIPLIERS.get(duration_unit)
-        duration_seconds = duration_value * multiplier if multiplier else duration_value
-
-    raw = {"attributes": attrib}
-    if metadata:
-        raw["metadata"] = metadata
-    if stats:
-        raw["statistics"] = stats
-    if routes:
-        raw["routes"] = routes
-    if extra_children:
-        raw["children"] = extra_children
-
-    metadata_json = json.dumps(metadata, separators=(",", ":"), sort_keys=True) if metadata else None
-    raw_json = json.dumps(raw, separators=(",", ":"), sort_keys=True)
-    workout_hash = hash_json(raw_json)
-
-    return (
-        attrib.get("workoutActivityType"),
-        attrib.get("sourceName"),
-        attrib.get("sourceVersion"),
-        attrib.get("sourceBundleIdentifier"),
-        attrib.get("device"),
-        attrib.get("startDate"),
-        attrib.get("endDate"),
-        duration_seconds,
-        duration_unit,
-        total_energy,
-        total_energy_unit,
-        total_distance,
-        total_distance_unit,
-        avg_hr,
-        min_hr,
-        max_hr,
-        route_file,
-        metadata_json,
-        workout_hash,
-        raw_json,
-    )
+    psycopg's queued writer sends the data from a background thread, so rows go
+    from the parse loop to the server without being collected into a batch.
+    """
+    with conn.cursor() as cur:
+        with cur.copy(
+            f"COPY {table}_stage ({', '.join(columns)}) FROM STDIN",
+            writer=QueuedLibpqWriter(cur),
+        ) as copy:
+            yield copy.write_row
 
 
-def insert_rows(conn, sql, rows, page_size):
+def insert_rows_copy(conn, table, columns, rows):
+    """COPY rows into the stage table, then merge them into the target."""
     if not rows:
         return 0
     with conn.cursor() as cur:
-        execute_values(cur, sql, rows, page_size=page_size)
-    conn.commit()
+        with cur.copy(f"COPY {table}_stage ({', '.join(columns)}) FROM STDIN") as copy:
+            write_row = copy.write_row
+            for row in rows:
+                write_row(row)
+    merge_stage(conn, table, columns)
     return len(rows)
 
 
@@ -277,13 +295,19 @@ def main():
         default=os.environ.get("DATABASE_URL"),
         help="Postgres connection URL (or set DATABASE_URL).",
     )
-    parser.add_argument("--batch-size", type=int, default=5000, help="Record batch size.")
+    parser.add_argument("--batch-size", type=int, default=20000, help="Record batch size.")
     parser.add_argument(
         "--workout-batch-size",
         type=int,
         default=500,
         help="Workout batch size.",
     )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=10,
+        help="Commit after every N record batches.",
+    )
     parser.add_argument(
         "--progress-every",
         type=int,
@@ -296,6 +320,23 @@ def main():
         action="store_true",
         help="Truncate target tables before loading.",
     )
+    parser.add_argument(
+        "--skip-raw",
+        action="store_true",
+        help=(
+            "Leave the raw JSONB column NULL and hash only attributes + metadata. "
+            "Faster, but hashes differ from a full load, so do not mix modes in one database."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help=(
+            "0 builds rows inline; 1 parses on a background thread while rows are "
+            "built and loaded; N > 1 builds rows in N worker processes."
+        ),
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -317,71 +358,95 @@ def main():
 
     conn = None
     if not args.dry_run:
-        if psycopg2 is None:
-            print("Missing dependency: psycopg2. Install from requirements.txt.", file=sys.stderr)
+        if psycopg is None:
+            print("Missing dependency: psycopg. Install from requirements.txt.", file=sys.stderr)
             return 1
         if not args.db_url:
             parser.error("DATABASE_URL or --db-url is required.")
-        conn = psycopg2.connect(args.db_url)
+        conn = psycopg.connect(args.db_url)
         conn.autocommit = False
+        # The load is idempotent on record_hash, so losing the last few
+        # commits in a crash only means re-running the import.
+        with conn.cursor() as cur:
+            cur.execute("SET synchronous_commit = off")
         if args.truncate:
             with conn.cursor() as cur:
                 cur.execute("TRUNCATE health_raw, workouts;")
             conn.commit()
+        create_stage_tables(conn)
 
-    record_rows = []
     workout_rows = []
     record_counts = Counter()
     records_processed = 0
     workouts_processed = 0
+    batches_since_commit = 0
     start_time = time.time()
 
-    # Track tags that should NOT be cleared (children of Record/Workout)
-    preserve_tags = {
-        "MetadataEntry", "WorkoutStatistics", "WorkoutEvent", "WorkoutRoute",
-        "FileReference", "HeartRateVariabilityMetadataList", "InstantaneousBeatsPerMinute"
-    }
+    # Bind loop invariants to locals; the loop below runs once per record.
+    dry_run = args.dry_run
+    batch_size = args.batch_size
+    workout_batch_size = args.workout_batch_size
+    commit_every = args.commit_every
+    progress_every = args.progress_every
+    limit = args.limit or 0
+    keep_raw = not args.skip_raw
+    workout_append = workout_rows.append
+    rows = iter_export_rows(export_path, keep_raw, args.workers)
+    finished = False
 
     try:
-        for event, elem in ET.iterparse(export_path, events=("end",)):
-            if elem.tag == "Record":
-                row = build_record_row(elem)
-                record_rows.append(row)
-                records_processed += 1
-                record_counts[row[0]] += 1
-
-                if not args.dry_run and len(record_rows) >= args.batch_size:
-                    insert_rows(conn, RECORD_INSERT_SQL, record_rows, args.batch_size)
-                    record_rows.clear()
-
-                if args.progress_every and records_processed % args.progress_every == 0:
-                    elapsed = max(time.time() - start_time, 0.001)
-                    rate = records_processed / elapsed
-                    print(
-                        f"Records: {records_processed:,} | Workouts: {workouts_processed:,} | "
-                        f"{rate:,.0f} rec/s"
-                    )
-
-                if args.limit and records_processed >= args.limit:
-                    break
-
-                elem.clear()
-            elif elem.tag == "Workout":
-                row = build_workout_row(elem)
-                workout_rows.append(row)
-                workouts_processed += 1
-
-                if not args.dry_run and len(workout_rows) >= args.workout_batch_size:
-                    insert_rows(conn, WORKOUT_INSERT_SQL, workout_rows, args.workout_batch_size)
-                    workout_rows.clear()
-
-                elem.clear()
-            elif elem.tag not in preserve_tags:
-                elem.clear()
+        while not finished:
+            # Records stream straight into health_raw_stage; only their types are
+            # kept, to be counted once per batch.
+            batch_types = []
+            type_append = batch_types.append
+            if dry_run:
+                record_copy = nullcontext(lambda row: None)
+            else:
+                record_copy = stream_stage_copy(conn, "health_raw", RECORD_COLUMNS)
+
+            with record_copy as write_record:
+                finished = True
+                for tag, row in rows:
+                    if tag == "Record":
+                        write_record(row)
+                        type_append(row[0])
+                        records_processed += 1
+
+                        if progress_every and records_processed % progress_every == 0:
+                            elapsed = max(time.time() - start_time, 0.001)
+                            rate = records_processed / elapsed
+                            print(
+                                f"Records: {records_processed:,} | "
+                                f"Workouts: {workouts_processed:,} | {rate:,.0f} rec/s"
+                            )
+
+                        if limit and records_processed >= limit:
+                            break
+                        if len(batch_types) >= batch_size:
+                            finished = False
+                            break
+                    else:
+                        workout_append(row)
+                        workouts_processed += 1
+
+            record_counts.update(batch_types)
+            if dry_run:
+                workout_rows.clear()
+                continue
+
+            # Workouts can only be loaded once the record COPY is closed.
+            merge_stage(conn, "health_raw", RECORD_COLUMNS)
+            if finished or len(workout_rows) >= workout_batch_size:
+                insert_rows_copy(conn, "workouts", WORKOUT_COLUMNS, workout_rows)
+                workout_rows.clear()
+            batches_since_commit += 1
+            if finished or batches_since_commit >= commit_every:
+                conn.commit()
+                batches_since_commit = 0
     finally:
-        if not args.dry_run:
-            insert_rows(conn, RECORD_INSERT_SQL, record_rows, args.batch_size)
-            insert_rows(conn, WORKOUT_INSERT_SQL, workout_rows, args.workout_batch_size)
+        rows.close()
+        if conn is not None:
             conn.close()
 
     elapsed = max(time.time() - start_time, 0.001)
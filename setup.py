@@ -0,0 +1,14 @@
+from setuptools import setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
+# Optional: compiles export_rows.py in place for a faster parse_export.py.
+#   python setup.py build_ext --inplace
+setup(
+    name="health-sync-export",
+    py_modules=["export_rows", "parse_export"],
+    ext_modules=cythonize("export_rows.py", language_level=3) if cythonize else [],
+)